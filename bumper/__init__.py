@@ -179,6 +179,7 @@ async def shutdown() -> None:
             if xmpp_server.server.is_serving:
                 xmpp_server.server.close()
             await xmpp_server.server.wait_closed()
+        xmpp_server.flush_xmpp_status()  # Don't drop pending status changes
 
         bumperlog.info("Shutdown complete")
     except asyncio.CancelledError:
@@ -232,6 +233,13 @@ def main(argv: None | list[str] = None) -> None:
         if args.announce:
             bumper_announce_ip = args.announce
 
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            bumperlog.debug("uvloop not available, using the default event loop")
+
         asyncio.run(start())
 
     except KeyboardInterrupt:
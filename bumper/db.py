@@ -400,6 +400,15 @@ def bot_set_xmpp(did: str, xmpp: bool) -> None:
     bots.upsert({"xmpp_connection": xmpp}, bot.did == did)
 
 
+def bots_set_xmpp(statuses: dict[str, bool]) -> None:
+    """Set XMPP status of existing bots by did in a single write."""
+    bots = _db_get().table("bots")
+    bot = Query()
+    bots.update_multiple(
+        [({"xmpp_connection": xmpp}, bot.did == did) for did, xmpp in statuses.items()]
+    )
+
+
 def client_add(userid: str, realm: str, resource: str) -> None:
     """Add client."""
     new_client = VacBotClient()
@@ -448,6 +457,18 @@ def client_set_xmpp(resource: str, xmpp: bool) -> None:
     clients.upsert({"xmpp_connection": xmpp}, client.resource == resource)
 
 
+def clients_set_xmpp(statuses: dict[str, bool]) -> None:
+    """Set XMPP status of existing clients by resource in a single write."""
+    clients = _db_get().table("clients")
+    client = Query()
+    clients.update_multiple(
+        [
+            ({"xmpp_connection": xmpp}, client.resource == resource)
+            for resource, xmpp in statuses.items()
+        ]
+    )
+
+
 def bot_reset_connection_status() -> None:
     """Reset all bot connection status."""
     bots = _db_get().table("bots")
@@ -1,41 +1,147 @@
 """XMPP module."""
 import asyncio
 import base64
+import logging
 import re
 import ssl
 import uuid
 import xml.etree.ElementTree as ET
 from asyncio import transports
-from typing import Optional
+from typing import Callable, Optional, cast
 
 import bumper
 from bumper.db import (
     bot_add,
-    bot_get,
-    bot_set_xmpp,
+    bots_set_xmpp,
     check_authcode,
     client_add,
-    client_get,
-    client_set_xmpp,
+    clients_set_xmpp,
 )
 
 xmppserverlog = bumper.get_logger("xmppserver")
 boterrorlog = bumper.get_logger("boterror")
 
+# ElementTree silently falls back to pure Python if _elementtree is missing
+if ET.Element is getattr(ET, "_Element_Py", None):
+    xmppserverlog.warning(
+        "C accelerated ElementTree is not available, xml parsing will be slow"
+    )
+
+
+# Prebuilt responses, filled in with bytes %-formatting
+_FEATURE_NOT_IMPLEMENTED = b'<iq type="error" id="%b"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'
+_BIND_RESULT = b'<iq type="result" id="%b"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>%b</jid></bind></iq>'
+_SESSION_RESULT = b'<iq type="result" id="%b" />'
+_STREAM_HEADER = b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="%b">'
+_FEATURES_STARTTLS = b'<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
+_FEATURES_SASL = b'<stream:features><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
+_FEATURES_BIND = b'<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
+_ADD_USER = b'<iq type="set" id="%b" from="%b" to="%b"><query xmlns="com:ctl"><ctl td="AddUser" id="0000" jid="%b" /></query></iq>'
+_ADD_USER_ACS = b'<iq type="set" id="%b" from="%b" to="%b"><query xmlns="com:ctl"><ctl td="SetAC" id="1111" jid="%b"><acs><ac name="userman" allow="1"/><ac name="setting" allow="1"/><ac name="clean" allow="1"/></acs></ctl></query></iq>'
+_GET_USER_INFO = b'<iq type="set" id="%b" from="%b" to="%b"><query xmlns="com:ctl"><ctl td="GetUserInfo" id="4444" /><UserInfos/></query></iq>'
+_PING_RESULT = b'<iq type="result" id="%b" from="%b" />'
+_PRESENCE_DUMMY = b'<presence to="%b"> dummy </presence>'
+_PING = b"<iq from='%b' to='%b' id='s2c1' type='get'><ping xmlns='urn:xmpp:ping'/></iq>"
+# iq types handled by _handle_result when there is no known child
+_RESULT_TYPES = frozenset(("result", "set"))
+_NOT_IMPLEMENTED_QUERY = re.compile(r"roster|disco#items|disco#info")
+
+
+def _namespace_cleanup(namespace: str, child: str) -> Callable[[bytes], bytes]:
+    """Return a cleanup of the namespace prefixes added by ET."""
+    root = f'iq xmlns="{namespace}"'.encode()
+    child_tag = f"<{child}".encode()
+    child_decl = f'<{child} xmlns="{namespace}"'.encode()
+
+    def cleanup(xmlbytes: bytes) -> bytes:
+        return (
+            xmlbytes.replace(b"xmlns:ns0=", b"xmlns=")
+            .replace(b"ns0:", b"")
+            .replace(root, b"iq")
+            .replace(child_tag, child_decl)
+        )
+
+    return cleanup
+
+
+_ctl_namespace_cleanup = _namespace_cleanup("com:ctl", "query")
+_ping_namespace_cleanup = _namespace_cleanup("urn:xmpp:ping", "ping")
+
+
+class _XMPPStatusBatch:
+    """Collect xmpp connection state changes and flush them to the db together."""
+
+    def __init__(self, delay: float):
+        self._delay = delay
+        self._bots: dict[str, bool] = {}
+        self._clients: dict[str, bool] = {}
+        # Loop with a pending flush, a closed loop will never run it
+        self._flush_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add(self, uid: str, resource: str, connected: bool) -> None:
+        """Queue a state change, the latest change per bot/client wins."""
+        if uid:
+            self._bots[uid] = connected
+        if resource:
+            self._clients[resource] = connected
+        loop = asyncio.get_running_loop()
+        if self._flush_loop is not loop:
+            self._flush_loop = loop
+            loop.call_later(self._delay, self.flush)
+
+    def flush(self) -> None:
+        """Write all queued state changes to the db."""
+        self._flush_loop = None
+        if not (self._bots or self._clients):
+            return
+
+        bots, self._bots = self._bots, {}
+        clients, self._clients = self._clients, {}
+        try:
+            if bots:
+                bots_set_xmpp(bots)
+            if clients:
+                clients_set_xmpp(clients)
+
+        except Exception as e:
+            xmppserverlog.error(f"{e}")
+
+
+_xmpp_status = _XMPPStatusBatch(0.05)
+
+
+def _is_bot_error(xml: ET.Element) -> bool:
+    """Check if a stanza contains an error or alert reported by a bot."""
+    for element in xml.iter():
+        if (
+            element.get("td") == "error"
+            or "errs" in element.attrib
+            or element.get("k", "").startswith("DeviceAlert")
+        ):
+            return True
+    return False
+
 
 class XMPPServer:
     """XMPP server."""
 
     server_id = "ecouser.net"
-    clients: list["XMPPAsyncClient"] = []
+    clients: dict[int, "XMPPAsyncClient"] = {}
+    clients_by_uid: dict[str, list["XMPPAsyncClient"]] = {}
     exit_flag = False
-    server = None
+    server: Optional[asyncio.AbstractServer] = None
 
     def __init__(self, host: str, port: int):
         # Initialize bot server
         self._host = host
         self._port = port
-        self.xmpp_protocol = lambda: XMPPServer_Protocol()
+
+        # Shared by all STARTTLS upgrades
+        self._ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self._ssl_ctx.load_cert_chain(bumper.server_cert, bumper.server_key)
+        self._ssl_ctx.load_verify_locations(cafile=bumper.ca_cert)
+
+        self.xmpp_protocol = lambda: XMPPServer_Protocol(self._ssl_ctx)
 
     async def start_async_server(self) -> None:
         """Start server."""
@@ -57,13 +163,18 @@ class XMPPServer:
     def disconnect(self) -> None:
         """Disconnect."""
         xmppserverlog.debug("waiting for all clients to disconnect")
-        for client in self.clients:
+        for client in list(self.clients.values()):
             client._disconnect()
+        self.flush_xmpp_status()
 
         self.exit_flag = True
         xmppserverlog.debug("shutting down")
         self.server_coro.cancel()
 
+    def flush_xmpp_status(self) -> None:
+        """Write the queued bot/client xmpp connection states to the db now."""
+        _xmpp_status.flush()
+
 
 class XMPPServer_Protocol(asyncio.Protocol):
     """XMPP server protocol."""
@@ -72,30 +183,33 @@ class XMPPServer_Protocol(asyncio.Protocol):
     exit_flag = False
     _client: Optional["XMPPAsyncClient"] = None
 
+    def __init__(self, ssl_ctx: ssl.SSLContext):
+        self.ssl_ctx = ssl_ctx
+
     def connection_made(self, transport: transports.BaseTransport) -> None:
         """Establish connection."""
         if self._client:  # Existing client... upgrading to TLS
-            xmppserverlog.debug(f"Upgraded connection for {self._client.address}")
+            xmppserverlog.debug("Upgraded connection for %s", self._client.address)
             self._client.transport = transport
         else:
             client = XMPPAsyncClient(transport)
             self._client = client
-            XMPPServer.clients.append(client)
-            self._client.state = getattr(client, "CONNECT")
-            xmppserverlog.debug(f"New Connection from {client.address}")
+            XMPPServer.clients[id(client)] = client
+            self._client.state = XMPPAsyncClient.CONNECT
+            xmppserverlog.debug("New Connection from %s", client.address)
 
     def connection_lost(self, exc: Exception | None) -> None:
         """Lost connection."""
         if self._client:
-            XMPPServer.clients.remove(self._client)
+            XMPPServer.clients.pop(id(self._client), None)
+            uid = self._client.uid.lower()
+            uid_clients = XMPPServer.clients_by_uid.get(uid, [])
+            if self._client in uid_clients:
+                uid_clients.remove(self._client)
+                if not uid_clients:  # Last connection of this uid
+                    XMPPServer.clients_by_uid.pop(uid, None)
             self._client.set_state("DISCONNECT")
-            xmppserverlog.debug(
-                "End Connection for ({}:{} | {})".format(
-                    self._client.address[0],
-                    self._client.address[1],
-                    self._client.bumper_jid,
-                )
-            )
+            xmppserverlog.debug("End Connection for %s", self._client._log_prefix)
 
     def data_received(self, data: bytes) -> None:
         """Parse received data."""
@@ -112,6 +226,14 @@ class XMPPAsyncClient:
     BIND = 3
     READY = 4
     DISCONNECT = 5
+    _STATES = {
+        "IDLE": IDLE,
+        "CONNECT": CONNECT,
+        "INIT": INIT,
+        "BIND": BIND,
+        "READY": READY,
+        "DISCONNECT": DISCONNECT,
+    }
     UNKNOWN = 0
     BOT = 1
     CONTROLLER = 2
@@ -126,53 +248,67 @@ class XMPPAsyncClient:
         self.devclass = ""
         self.bumper_jid = ""
         self.uid = ""
+        self._ping_task: Optional[asyncio.Task] = None
+        self._tls_task: Optional[asyncio.Task] = None
         self.log_sent_message = True  # Set to true to log sends
         self.log_incoming_data = True  # Set to true to log sends
-        xmppserverlog.debug(f"new client with ip {self.address}")
-
-    def send(self, command: str) -> None:
+        # Decided once per connection, a no-op unless debugging incoming data
+        self._log_unparsed: Callable[[ET.Element], None] = (
+            self._log_unparsed_item
+            if self.log_incoming_data and xmppserverlog.isEnabledFor(logging.DEBUG)
+            else lambda item: None
+        )
+        self._log_prefix = f"({self.address[0]}:{self.address[1]} | )"
+        self._reset_parser()
+        xmppserverlog.debug("new client with ip %s", self.address)
+
+    def send(self, command: bytes | str) -> None:
         """Send command."""
         try:
+            if isinstance(command, str):
+                command = command.encode()
             if self.log_sent_message:
-                xmppserverlog.debug(
-                    "send to ({}:{} | {}) - {}".format(
-                        self.address[0], self.address[1], self.bumper_jid, command
-                    )
-                )
-            if isinstance(self.transport, transports.WriteTransport):
-                self.transport.write(command.encode())
+                xmppserverlog.debug("send to %s - %s", self._log_prefix, command)
+            # uvloop transports are not transports.WriteTransport subclasses
+            transport = cast(transports.Transport, self.transport)
+            if transport is not None and not transport.is_closing():
+                transport.write(command)
 
         except Exception as e:
             xmppserverlog.exception(f"{e}")
 
-    def _disconnect(self) -> None:
+    def send_many(self, commands: list[bytes]) -> None:
+        """Send several commands with a single write."""
         try:
+            if self.log_sent_message and xmppserverlog.isEnabledFor(logging.DEBUG):
+                for command in commands:
+                    xmppserverlog.debug("send to %s - %s", self._log_prefix, command)
+            transport = cast(transports.Transport, self.transport)
+            if transport is not None and not transport.is_closing():
+                transport.writelines(commands)
 
-            bot = bot_get(self.uid)
-            if bot:
-                bot_set_xmpp(bot["did"], False)
+        except Exception as e:
+            xmppserverlog.exception(f"{e}")
 
-            client = client_get(self.clientresource)
-            if client:
-                client_set_xmpp(client["resource"], False)
+    def _disconnect(self) -> None:
+        try:
+            if self._ping_task:
+                self._ping_task.cancel()
 
+            self._update_xmpp_status(False)
             self.transport.close()
 
         except Exception as e:
             xmppserverlog.error(f"{e}")
 
-    def _tag_strip_uri(self, tag: str) -> str:
-        try:
-            if tag[0] == "{":
-                _, _, tag = tag[1:].partition("}")
-        except Exception as e:
-            xmppserverlog.error(f"{e}")
-        return tag
+    def _update_xmpp_status(self, connected: bool) -> None:
+        # Batched, TinyDB is not thread safe so it is written on the loop thread
+        _xmpp_status.add(self.uid, self.clientresource, connected)
 
     def set_state(self, state: str) -> None:
         """Set state."""
         try:
-            new_state = getattr(XMPPAsyncClient, state)
+            new_state = self._STATES[state]
             if self.state > new_state:
                 raise Exception(
                     "{} illegal state change {}->{}".format(
@@ -180,53 +316,27 @@ class XMPPAsyncClient:
                     )
                 )
 
-            xmppserverlog.debug(
-                "({}:{} | {}) state: {}".format(
-                    self.address[0], self.address[1], self.bumper_jid, state
-                )
-            )
+            xmppserverlog.debug("%s state: %s", self._log_prefix, state)
 
             self.state = new_state
 
-            if new_state == 5:
+            if new_state == self.DISCONNECT:
                 self._disconnect()
 
         except Exception as e:
             xmppserverlog.error(f"{e}")
 
-    def _handle_ctl(self, xml: ET.Element, data: str) -> None:
+    def _handle_ctl(self, xml: ET.Element) -> None:
         try:
-
-            if "roster" in data:
-                # Return not-implemented for roster
-                self.send(
-                    '<iq type="error" id="{}"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'.format(
-                        xml.get("id")
-                    )
-                )
-                return
-
-            if "disco#items" in data:
-                # Return  not-implemented for disco#items
-                self.send(
-                    '<iq type="error" id="{}"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'.format(
-                        xml.get("id")
-                    )
-                )
-                return
-
-            if "disco#info" in data:
-                # Return not-implemented for disco#info
-                self.send(
-                    '<iq type="error" id="{}"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'.format(
-                        xml.get("id")
-                    )
-                )
+            query = xml[0].tag
+            if _NOT_IMPLEMENTED_QUERY.search(query):
+                # Return not-implemented for roster, disco#items and disco#info
+                self.send(_FEATURE_NOT_IMPLEMENTED % xml.get("id", "").encode())
                 return
 
             if xml.get("type") == "set":
                 if (
-                    "com:sf" in data and xml.get("to") == "rl.ecorobot.net"
+                    query == "{com:sf}query" and xml.get("to") == "rl.ecorobot.net"
                 ):  # Android bind? Not sure what this does yet.
                     self.send(
                         '<iq id="{}" to="{}@{}/{}" from="rl.ecorobot.net" type="result"/>'.format(
@@ -247,25 +357,29 @@ class XMPPAsyncClient:
                     return
 
             # forward
-            for client in XMPPServer.clients:
-                if (
-                    client.bumper_jid != self.bumper_jid
-                    and client.state == client.READY
-                ):
-                    ctl_to = xml.get("to")
-                    if "from" not in xml.attrib:
-                        xml.attrib["from"] = f"{self.bumper_jid}"
-                    rxmlstring = ET.tostring(xml).decode("utf-8")
-                    # clean up string to remove namespaces added by ET
-                    rxmlstring = rxmlstring.replace("xmlns:ns0=", "xmlns=")
-                    rxmlstring = rxmlstring.replace("ns0:", "")
-                    rxmlstring = rxmlstring.replace('iq xmlns="com:ctl"', "iq")
-                    rxmlstring = rxmlstring.replace("<query", '<query xmlns="com:ctl"')
-
-                    if client.type == self.BOT and ctl_to:
-                        if client.uid.lower() in ctl_to.lower():
-                            xmppserverlog.debug(f"Sending ctl to bot: {rxmlstring}")
-                            client.send(rxmlstring)
+            ctl_to = xml.get("to")
+            if not ctl_to:
+                return
+
+            recipients = [
+                client
+                for client in XMPPServer.clients_by_uid.get(
+                    ctl_to.split("@", 1)[0].lower(), []
+                )
+                if client.bumper_jid != self.bumper_jid
+                and client.state == client.READY
+                and client.type == self.BOT
+            ]
+            if not recipients:  # Nothing to forward, skip serializing
+                return
+
+            if "from" not in xml.attrib:
+                xml.attrib["from"] = f"{self.bumper_jid}"
+            # clean up string to remove namespaces added by ET
+            rxmlbytes = _ctl_namespace_cleanup(ET.tostring(xml))
+            for client in recipients:
+                xmppserverlog.debug("Sending ctl to bot: %s", rxmlbytes)
+                client.send(rxmlbytes)
 
         except Exception as e:
             xmppserverlog.error(f"{e}")
@@ -275,69 +389,64 @@ class XMPPAsyncClient:
             pingto = xml.get("to")
             if pingto and pingto.find("@") == -1:  # No to address
                 # Ping to server - respond
-                pingresp = '<iq type="result" id="{}" from="{}" />'.format(
-                    xml.get("id"), xml.get("to")
-                )
-                # xmppserverlog.debug("Server Ping resp: {}".format(pingresp))
-                self.send(pingresp)
+                self.send(_PING_RESULT % (xml.get("id", "").encode(), pingto.encode()))
+
+            elif pingto:
+                recipients = [
+                    client
+                    for client in XMPPServer.clients_by_uid.get(
+                        pingto.split("@", 1)[0].lower(), []
+                    )
+                    if client.bumper_jid != self.bumper_jid
+                    and client.state == client.READY
+                ]
+                if not recipients:  # Nothing to forward, skip serializing
+                    return
 
-            else:
                 pingfrom = self.bumper_jid
                 if "from" not in xml.attrib:
                     xml.attrib["from"] = f"{pingfrom}"
-                pingstring = ET.tostring(xml).decode("utf-8")
                 # clean up string to remove namespaces added by ET
-                pingstring = pingstring.replace("xmlns:ns0=", "xmlns=")
-                pingstring = pingstring.replace("ns0:", "")
-                pingstring = pingstring.replace('iq xmlns="urn:xmpp:ping"', "iq")
-                pingstring = pingstring.replace("<ping", '<ping xmlns="urn:xmpp:ping"')
-
-                for client in XMPPServer.clients:
-                    if (
-                        client.bumper_jid != self.bumper_jid
-                        and client.state == client.READY
-                        and pingto
-                    ):
-                        if client.uid.lower() in pingto.lower():
-                            client.send(pingstring)
+                pingbytes = _ping_namespace_cleanup(ET.tostring(xml))
+                for client in recipients:
+                    client.send(pingbytes)
 
         except Exception as e:
             xmppserverlog.exception(f"{e}")
 
-    async def schedule_ping(self, time: int) -> None:
-        """Schedule ping."""
-        if not self.state == 5:  # disconnected
-            pingstring = "<iq from='{}' to='{}' id='s2c1' type='get'><ping xmlns='urn:xmpp:ping'/></iq>".format(
-                XMPPServer.server_id, self.bumper_jid
-            )
-            self.send(pingstring)
-            await asyncio.sleep(time)
-            asyncio.Task(self.schedule_ping(time))
+    async def _ping_loop(self, interval: int) -> None:
+        """Ping the client every interval seconds until it disconnects."""
+        ping = _PING % (XMPPServer.server_id.encode(), self.bumper_jid.encode())
+        while self.state != self.DISCONNECT:
+            self.send(ping)
+            await asyncio.sleep(interval)
 
-    def _handle_result(self, xml: ET.Element, data: str) -> None:
+    def _handle_result(self, xml: ET.Element) -> None:
         try:
             ctl_to = xml.get("to")
             if "from" not in xml.attrib:
                 xml.attrib["from"] = f"{self.bumper_jid}"
-            if "errno" in data:
-                xmppserverlog.error(f"Error from bot - {data}")
+            ctl = next((e for e in xml.iter() if "errno" in e.attrib), None)
+            if ctl is not None:
+                xmppserverlog.error(
+                    "Error from bot - %s",
+                    _ctl_namespace_cleanup(ET.tostring(xml)).decode("utf-8"),
+                )
             if (
-                "errno='103'" in data
+                ctl is not None and ctl.get("errno") == "103"
             ):  # No permissions, usually if bot was last on Ecovac network, Bumper will try to add fuid user as owner
                 if self.type == self.BOT:
                     xmppserverlog.info(
                         "Bot reported user has no permissions, Bumper will attempt to add user to bot. This is typical if bot was last on Ecovacs Network."
                     )
-                    xquery = list(xml)
-                    ctl = list(xquery[0])
-                    if "error" in ctl[0].attrib:
-                        ctlerr = ctl[0].attrib["error"]
+                    if "error" in ctl.attrib:
+                        ctlerr = ctl.attrib["error"]
                         adminuser = ctlerr.replace(
                             "permission denied, please contact ", ""
                         )
                         adminuser = adminuser.replace(" ", "")
-                    elif "admin" in ctl[0].attrib:
-                        adminuser = ctl[0].attrib["admin"]
+                    elif "admin" in ctl.attrib:
+                        adminuser = ctl.attrib["admin"]
                     if ctl_to and not (
                         adminuser.startswith("fuid_")
                         or adminuser.startswith("fusername_")
@@ -348,42 +457,45 @@ class XMPPAsyncClient:
 
                         # Add user jid to bot
                         newuser = ctl_to.split("/")[0]
-                        adduser = '<iq type="set" id="{}" from="{}" to="{}"><query xmlns="com:ctl"><ctl td="AddUser" id="0000" jid="{}" /></query></iq>'.format(
-                            uuid.uuid4(), adminuser, self.bumper_jid, newuser
+                        admin = adminuser.encode()
+                        jid = self.bumper_jid.encode()
+                        newjid = newuser.encode()
+                        adduser = _ADD_USER % (
+                            str(uuid.uuid4()).encode(),
+                            admin,
+                            jid,
+                            newjid,
                         )
-                        xmppserverlog.debug(f"Adding User to bot - {adduser}")
-                        self.send(adduser)
+                        xmppserverlog.debug("Adding User to bot - %s", adduser)
 
                         # Add user ACs - Manage users, settings, and clean (full access)
-                        adduseracs = '<iq type="set" id="{}" from="{}" to="{}"><query xmlns="com:ctl"><ctl td="SetAC" id="1111" jid="{}"><acs><ac name="userman" allow="1"/><ac name="setting" allow="1"/><ac name="clean" allow="1"/></acs></ctl></query></iq>'.format(
-                            uuid.uuid4(), adminuser, self.bumper_jid, newuser
+                        adduseracs = _ADD_USER_ACS % (
+                            str(uuid.uuid4()).encode(),
+                            admin,
+                            jid,
+                            newjid,
                         )
-                        xmppserverlog.debug(f"Add User ACs to bot - {adduseracs}")
-                        self.send(adduseracs)
+                        xmppserverlog.debug("Add User ACs to bot - %s", adduseracs)
 
                         # GetUserInfo - Just to confirm it set correctly
-                        self.send(
-                            '<iq type="set" id="{}" from="{}" to="{}"><query xmlns="com:ctl"><ctl td="GetUserInfo" id="4444" /><UserInfos/></query></iq>'.format(
-                                uuid.uuid4(), adminuser, self.bumper_jid
-                            )
+                        getuserinfo = _GET_USER_INFO % (
+                            str(uuid.uuid4()).encode(),
+                            admin,
+                            jid,
                         )
 
+                        self.send_many([adduser, adduseracs, getuserinfo])
+
             else:
-                rxmlstring = ET.tostring(xml).decode("utf-8")
                 # clean up string to remove namespaces added by ET
-                rxmlstring = rxmlstring.replace("xmlns:ns0=", "xmlns=")
-                rxmlstring = rxmlstring.replace("ns0:", "")
-                rxmlstring = rxmlstring.replace('iq xmlns="com:ctl"', "iq")
-                rxmlstring = rxmlstring.replace("<query", '<query xmlns="com:ctl"')
+                rxmlbytes = _ctl_namespace_cleanup(ET.tostring(xml))
                 if self.type == self.BOT:
                     if ctl_to == "de.ecorobot.net":  # Send to all clients
                         xmppserverlog.debug(
-                            "Sending to all clients because of de: {}".format(
-                                rxmlstring
-                            )
+                            "Sending to all clients because of de: %s", rxmlbytes
                         )
-                        for client in XMPPServer.clients:
-                            client.send(rxmlstring)
+                        for client in XMPPServer.clients.values():
+                            client.send(rxmlbytes)
 
                 to = xml.get("to")
                 if to and to.find("@") == -1:  # No to address
@@ -392,24 +504,29 @@ class XMPPAsyncClient:
                     assert ctl_to
                     ctl_to = "{}@ecouser.net".format(ctl_to.split("@")[0])
 
-                for client in XMPPServer.clients:
-                    if (
-                        client.bumper_jid != self.bumper_jid
-                        and client.state == client.READY
-                    ):
-                        if "@" not in ctl_to:  # No user@, send to all clients?
-                            # TODO: Revisit later, this may be wrong
-                            client.send(rxmlstring)
-
-                        elif (
-                            client.uid.lower() in ctl_to.lower()
-                        ):  # If client matches TO=
+                if "@" not in ctl_to:  # No user@, send to all clients?
+                    # TODO: Revisit later, this may be wrong
+                    for client in XMPPServer.clients.values():
+                        if (
+                            client.bumper_jid != self.bumper_jid
+                            and client.state == client.READY
+                        ):
+                            client.send(rxmlbytes)
+
+                else:  # Only clients matching TO=
+                    uid = ctl_to.split("@", 1)[0].lower()
+                    for client in XMPPServer.clients_by_uid.get(uid, []):
+                        if (
+                            client.bumper_jid != self.bumper_jid
+                            and client.state == client.READY
+                        ):
                             xmppserverlog.debug(
-                                "Sending from {} to client {}: {}".format(
-                                    self.uid, client.uid, rxmlstring
-                                )
+                                "Sending from %s to client %s: %s",
+                                self.uid,
+                                client.uid,
+                                rxmlbytes,
                             )
-                            client.send(rxmlstring)
+                            client.send(rxmlbytes)
 
         except Exception as e:
             xmppserverlog.exception(f"{e}")
@@ -420,31 +537,25 @@ class XMPPAsyncClient:
             if self.state == self.CONNECT:
                 if xml is None:
                     # Client first connecting, send our features
-                    if data.decode("utf-8").find("jabber:client") > -1:
-                        sc = data.decode("utf-8").find("to=")
-                        ec = data.decode("utf-8").find(".ecorobot.net")
+                    if b"jabber:client" in data:
+                        sc = data.find(b"to=")
+                        ec = data.find(b".ecorobot.net")
                         if ec > -1:
-                            self.devclass = data.decode("utf-8")[sc + 4 : ec]
+                            self.devclass = data[sc + 4 : ec].decode("utf-8")
                         # ack jabbr:client
                         # Send stream tag to client, acknowledging connection
-                        self.send(
-                            '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="{}">'.format(
-                                XMPPServer.server_id
-                            )
-                        )
+                        stream = _STREAM_HEADER % XMPPServer.server_id.encode()
 
                         # Send STARTTLS to client with auth mechanisms
                         if not self.TLSUpgraded:
                             # With STARTTLS #https://xmpp.org/rfcs/rfc3920.html
-                            self.send(
-                                '<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-                            )
+                            features = _FEATURES_STARTTLS
 
                         else:
                             # Already using TLS send authentication support for SASL
-                            self.send(
-                                '<stream:features><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-                            )
+                            features = _FEATURES_SASL
+
+                        self.send_many([stream, features])
 
                     else:
                         self.send("</stream>")
@@ -460,23 +571,14 @@ class XMPPAsyncClient:
             elif self.state == self.INIT:
                 if xml is None:
                     # Client getting session after authentication
-                    if data.decode("utf-8").find("jabber:client") > -1:
+                    if b"jabber:client" in data:
                         # ack jabbr:client
-                        self.send(
-                            '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="{}">'.format(
-                                XMPPServer.server_id
-                            )
-                        )
-
-                        self.send(
-                            '<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
-                        )
+                        stream = _STREAM_HEADER % XMPPServer.server_id.encode()
+                        self.send_many([stream, _FEATURES_BIND])
 
                 else:  # Handle init bind
-                    if len(xml):
-                        child = self._tag_strip_uri(xml[0].tag)
-                    else:
-                        child = None
+                    # Strip the {namespace} from the child tag
+                    child = xml[0].tag.rpartition("}")[2] if len(xml) else None
 
                     if xml.tag == "iq":
                         if child == "bind":
@@ -504,13 +606,10 @@ class XMPPAsyncClient:
                 loop = asyncio.get_event_loop()
                 transport = self.transport
                 protocol = self.transport.get_protocol()
-
-                ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                ssl_ctx.load_cert_chain(bumper.server_cert, bumper.server_key)
-                ssl_ctx.load_verify_locations(cafile=bumper.ca_cert)
+                assert isinstance(protocol, XMPPServer_Protocol)
 
                 new_transport = await loop.start_tls(
-                    transport, protocol, ssl_ctx, server_side=True
+                    transport, protocol, protocol.ssl_ctx, server_side=True
                 )
                 protocol.connection_made(new_transport)
 
@@ -520,20 +619,17 @@ class XMPPAsyncClient:
     def _handle_sasl_auth(self, xml: ET.Element) -> None:
         try:
             assert xml.text
-            saslauth = base64.b64decode(xml.text).decode("utf-8").split("/")
-            username = saslauth[0]
-            username = saslauth[0].split("\x00")[1]
+            saslauth = base64.b64decode(xml.text).split(b"/")
+            credentials = saslauth[0].split(b"\x00")
             authcode = ""
-            self.uid = username
+            self.uid = credentials[1].decode("utf-8")
             if len(saslauth) > 1:
-                resource = saslauth[1]
-                self.clientresource = resource
-            elif len(saslauth[0].split("\x00")) > 2:
-                resource = saslauth[0].split("\x00")[2]
-                self.clientresource = resource
+                self.clientresource = saslauth[1].decode("utf-8")
+            elif len(credentials) > 2:
+                self.clientresource = credentials[2].decode("utf-8")
 
             if len(saslauth) > 2:
-                authcode = saslauth[2]
+                authcode = saslauth[2].decode("utf-8")
 
             if self.devclass:  # if there is a devclass it is a bot
                 bot_add(self.uid, self.uid, self.devclass, "atom", "eco-legacy")
@@ -578,14 +674,7 @@ class XMPPAsyncClient:
 
     def _handle_bind(self, xml: ET.Element) -> None:
         try:
-
-            bot = bot_get(self.uid)
-            if bot:
-                bot_set_xmpp(bot["did"], True)
-
-            client = client_get(self.clientresource)
-            if client:
-                client_set_xmpp(client["resource"], True)
+            self._update_xmpp_status(True)
 
             clientbindxml = list(xml)
             clientresourcexml = list(clientbindxml[0])
@@ -594,14 +683,6 @@ class XMPPAsyncClient:
                 self.bumper_jid = "{}@{}.ecorobot.net/atom".format(
                     self.uid, self.devclass
                 )
-                xmppserverlog.debug(
-                    "new bot ({}:{} | {})".format(
-                        self.address[0], self.address[1], self.bumper_jid
-                    )
-                )
-                res = '<iq type="result" id="{}"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>{}</jid></bind></iq>'.format(
-                    xml.get("id"), self.bumper_jid
-                )
             elif len(clientresourcexml) > 0:
                 assert clientresourcexml[0].text
                 self.clientresource = clientresourcexml[0].text
@@ -609,50 +690,45 @@ class XMPPAsyncClient:
                 self.bumper_jid = "{}@{}/{}".format(
                     self.uid, XMPPServer.server_id, self.clientresource
                 )
-                xmppserverlog.debug(
-                    "new client ({}:{} | {})".format(
-                        self.address[0], self.address[1], self.bumper_jid
-                    )
-                )
-                res = '<iq type="result" id="{}"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>{}</jid></bind></iq>'.format(
-                    xml.get("id"), self.bumper_jid
-                )
             else:
                 self.name = f"XMPP_Client_{self.uid}_{self.address}"
                 self.bumper_jid = f"{self.uid}@{XMPPServer.server_id}"
-                xmppserverlog.debug(
-                    "new client ({}:{} | {})".format(
-                        self.address[0], self.address[1], self.bumper_jid
-                    )
-                )
-                res = '<iq type="result" id="{}"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>{}</jid></bind></iq>'.format(
-                    xml.get("id"), self.bumper_jid
-                )
+
+            self._log_prefix = (
+                f"({self.address[0]}:{self.address[1]} | {self.bumper_jid})"
+            )
+            xmppserverlog.debug(
+                "new %s %s", "bot" if self.devclass else "client", self._log_prefix
+            )
+
+            uid_clients = XMPPServer.clients_by_uid.setdefault(self.uid.lower(), [])
+            if self not in uid_clients:
+                uid_clients.append(self)
 
             self.set_state("BIND")
-            self.send(res)
+            self.send(
+                _BIND_RESULT % (xml.get("id", "").encode(), self.bumper_jid.encode())
+            )
 
         except Exception as e:
             xmppserverlog.exception(f"{e}")
 
     def _handle_session(self, xml: ET.Element) -> None:
-        res = '<iq type="result" id="{}" />'.format(xml.get("id"))
         self.set_state("READY")
-        self.send(res)
-        asyncio.Task(self.schedule_ping(30))
+        self.send(_SESSION_RESULT % xml.get("id", "").encode())
+        self._ping_task = asyncio.create_task(self._ping_loop(30))
 
     def _handle_presence(self, xml: ET.Element) -> None:
 
         if len(xml) and xml[0].tag == "status":
-            xmppserverlog.debug(
-                "bot presence {} ".format(
-                    ET.tostring(xml, encoding="utf-8").decode("utf-8")
+            if xmppserverlog.isEnabledFor(logging.DEBUG):
+                xmppserverlog.debug(
+                    "bot presence %s ", ET.tostring(xml, encoding="unicode")
                 )
-            )
             # Most likely a bot, possibly hello world in text
 
             # Send dummy return
-            self.send(f'<presence to="{self.bumper_jid}"> dummy </presence>')
+            self.send(_PRESENCE_DUMMY % self.bumper_jid.encode())
 
             # If it is a BOT, send extras
             if self.type == self.BOT:
@@ -664,173 +740,163 @@ class XMPPAsyncClient:
                 )
 
         else:
-            xmppserverlog.debug(
-                "client presence - {} ".format(
-                    ET.tostring(xml, encoding="utf-8").decode("utf-8")
+            if xmppserverlog.isEnabledFor(logging.DEBUG):
+                xmppserverlog.debug(
+                    "client presence - %s ", ET.tostring(xml, encoding="unicode")
                 )
-            )
 
             if xml.get("type") == "available":
-                xmppserverlog.debug(
-                    "client presence available - {} ".format(
-                        ET.tostring(xml, encoding="utf-8").decode("utf-8")
+                if xmppserverlog.isEnabledFor(logging.DEBUG):
+                    xmppserverlog.debug(
+                        "client presence available - %s ",
+                        ET.tostring(xml, encoding="unicode"),
                     )
-                )
 
                 # Send dummy return
-                self.send(f'<presence to="{self.bumper_jid}"> dummy </presence>')
+                self.send(_PRESENCE_DUMMY % self.bumper_jid.encode())
             elif xml.get("type") == "unavailable":
-                xmppserverlog.debug(
-                    "client presence unavailable (DISCONNECT) - {} ".format(
-                        ET.tostring(xml, encoding="utf-8").decode("utf-8")
+                if xmppserverlog.isEnabledFor(logging.DEBUG):
+                    xmppserverlog.debug(
+                        "client presence unavailable (DISCONNECT) - %s ",
+                        ET.tostring(xml, encoding="unicode"),
                     )
-                )
 
                 self.set_state("DISCONNECT")
             else:
                 # Sometimes the android app sends these
-                xmppserverlog.debug(
-                    "client presence (UNKNOWN) - {} ".format(
-                        ET.tostring(xml, encoding="utf-8")
+                if xmppserverlog.isEnabledFor(logging.DEBUG):
+                    xmppserverlog.debug(
+                        "client presence (UNKNOWN) - %s ",
+                        ET.tostring(xml, encoding="unicode"),
                     )
-                )
                 # Send dummy return
-                self.send(f'<presence to="{self.bumper_jid}"> dummy </presence>')
+                self.send(_PRESENCE_DUMMY % self.bumper_jid.encode())
+
+    def _log_unparsed_item(self, item: ET.Element) -> None:
+        xmppserverlog.debug("Unparsed Item - %s", ET.tostring(item, encoding="unicode"))
+
+    def _reset_parser(self) -> None:
+        """Start a new incremental parser with an artificial root."""
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._parser.feed(b"<root>")
+        self._root: Optional[ET.Element] = None  # Set by its start event
+        self._depth = 0
 
     def parse_data(self, data: bytes) -> None:
         """Parse data."""
 
-        if data.decode("utf-8").startswith(
-            "<?xml"
-        ):  # Strip <?xml and add artificial root
-            newdata = (
-                re.sub(r"(<\?xml[^>]+\?>)", r"<root>", data.decode("utf-8")) + "</root>"
-            )
+        if data.startswith(b"<?xml"):  # Strip <?xml ... ?> declaration
+            decl_end = data.find(b"?>")
+            data = data[decl_end + 2 :] if decl_end > -1 else b""
+
+        # Most packets are plain stanzas, one scan rules out both stream markers
+        stream_end = -1
+        if b"stream:stream" in data:
+            stream_start = data.find(b"<stream:stream")
+            if stream_start > -1:  # Handle start stream and connect
+                if self.state == self.CONNECT or self.state == self.INIT:
+                    xmppserverlog.debug("Handling connect data - %r", data)
+                    self._handle_connect(data[stream_start:])
+                # A new stream header (re)starts the document, e.g. after auth/tls
+                self._reset_parser()
+                header_end = data.find(b">", stream_start)
+                data = data[header_end + 1 :] if header_end > -1 else b""
+                if not data:  # Only the stream header, nothing to parse
+                    return
 
-        else:
-            newdata = "<root>{}</root>".format(
-                data.decode("utf-8")
-            )  # Add artificial root
+            stream_end = data.find(b"</stream:stream>")
+            if stream_end > -1:
+                data = data[:stream_end]
 
         try:
-            root = ET.fromstring(newdata)
-            for item in root.iter():
-                if item.tag != "root":
-                    if item.tag == "iq":
-                        if self.log_incoming_data:
-                            xmppserverlog.debug(
-                                "from ({}:{} | {}) - {}".format(
-                                    self.address[0],
-                                    self.address[1],
-                                    self.bumper_jid,
-                                    str(
-                                        ET.tostring(item, encoding="utf-8").decode(
-                                            "utf-8"
-                                        )
-                                    ).replace("ns0:", ""),
-                                )
-                            )
-                            if (
-                                'td="error"' in newdata
-                                or "errs=" in newdata
-                                or 'k="DeviceAlert' in newdata
-                            ):
-                                boterrorlog.error(
-                                    "Received Error from ({}:{} | {}) - {}".format(
-                                        self.address[0],
-                                        self.address[1],
-                                        self.bumper_jid,
-                                        newdata,
+            self._parser.feed(data)
+            # Parser state is kept in locals while draining the events
+            depth = self._depth
+            root = self._root
+            try:
+                for event, item in self._parser.read_events():
+                    if event == "start":
+                        if not depth:
+                            root = self._root = item
+                        depth += 1
+                        continue
+
+                    depth -= 1
+                    if depth != 1:  # Not a complete top-level stanza yet
+                        continue
+
+                    tag = item.tag
+                    local = tag.rpartition("}")[2]  # Tag without {namespace}
+                    try:
+                        if tag == "iq":
+                            if self.log_incoming_data:
+                                if xmppserverlog.isEnabledFor(logging.DEBUG):
+                                    xmppserverlog.debug(
+                                        "from %s - %s",
+                                        self._log_prefix,
+                                        ET.tostring(item, encoding="unicode"),
                                     )
-                                )
-                        self._handle_iq(item, newdata)
-                        item.clear()
-
-                    elif "auth" in item.tag:
-                        if "urn:ietf:params:xml:ns:xmpp-sasl" in item.tag:  # SASL Auth
-                            self._handle_sasl_auth(item)
-                            item.clear()
-
-                    elif "-tls" in item.tag:
-                        if not self.TLSUpgraded:
-                            asyncio.Task(self._handle_starttls(newdata.encode("utf-8")))
+                                if _is_bot_error(item):
+                                    boterrorlog.error(
+                                        "Received Error from %s - %s",
+                                        self._log_prefix,
+                                        _ctl_namespace_cleanup(
+                                            ET.tostring(item)
+                                        ).decode("utf-8"),
+                                    )
+                            self._handle_iq(item)
 
-                    elif "presence" in item.tag:
-                        self._handle_presence(item)
-                        item.clear()
+                        elif local == "auth":
+                            if tag.startswith("{urn:ietf:params:xml:ns:xmpp-sasl}"):
+                                self._handle_sasl_auth(item)
 
-                    else:
-                        if self.log_incoming_data:
-                            xmppserverlog.debug(
-                                "Unparsed Item - {}".format(
-                                    str(
-                                        ET.tostring(item, encoding="utf-8").decode(
-                                            "utf-8"
-                                        )
-                                    ).replace("ns0:", "")
+                        elif local == "starttls":
+                            if not self.TLSUpgraded:
+                                self._tls_task = asyncio.create_task(
+                                    self._handle_starttls(data)
                                 )
-                            )
 
-        except ET.ParseError as e:
-            if (
-                "no element found" in e.msg
-            ):  # Element not closed or not all bytes received
-                # Happens with connect stream often
-                if "<stream:stream " in newdata:
-                    if self.state == self.CONNECT or self.state == self.INIT:
-                        self._handle_connect(newdata.encode("utf-8"))
-                else:
-                    if not (newdata == "" or newdata == " "):
-                        xmppserverlog.error(f"xml parse error - {newdata} - {e}")
+                        elif local == "presence":
+                            self._handle_presence(item)
 
-            elif "not well-formed (invalid token)" in e.msg:
-                # If a lone </stream:stream> - client is signalling end of session/disconnect
-                if "</stream:stream>" not in newdata:
-                    xmppserverlog.error(f"xml parse error - {newdata} - {e}")
-                else:
-                    self.send("</stream:stream>")  # Close stream
+                        else:
+                            self._log_unparsed(item)
+                    finally:
+                        # Stanza is handled, drop it so the root does not keep growing
+                        if root is not None:
+                            root.remove(item)
+            finally:
+                self._depth = depth
 
-            else:
-                if "<stream:stream" in newdata:  # Handle start stream and connect
-                    if self.state == self.CONNECT or self.state == self.INIT:
-                        xmppserverlog.debug(f"Handling connect data - {newdata}")
-                        self._handle_connect(newdata.encode("utf-8"))
-                else:
-                    if "</stream:stream>" not in newdata:
-                        xmppserverlog.error(f"xml parse error - {newdata} - {e}")
-                    else:
-                        self.send("</stream:stream>")  # Close stream
-                        self.set_state("DISCONNECT")
+        except ET.ParseError as e:
+            xmppserverlog.error(f"xml parse error - {data!r} - {e}")
+            self._reset_parser()
 
         except Exception as e:
             xmppserverlog.exception(f"{e}")
 
-    def _handle_iq(self, xml: ET.Element, data: str) -> None:
+        if stream_end > -1:
+            # Client is signalling end of session/disconnect
+            self.send("</stream:stream>")  # Close stream
+            self.set_state("DISCONNECT")
 
-        if len(xml):
-            child = self._tag_strip_uri(xml[0].tag)
-        else:
-            child = None
+    def _handle_iq(self, xml: ET.Element) -> None:
+
+        # Strip the {namespace} from the child tag
+        child = xml[0].tag.rpartition("}")[2] if len(xml) else ""
 
         if xml.tag == "iq":
-            if child == "bind":
-                self._handle_bind(xml)
-            elif child == "session":
-                self._handle_session(xml)
-            elif child == "ping":
-                self._handle_ping(xml)
-            elif child == "query":
-                if self.type == self.BOT:
-                    self._handle_result(xml, data)
-                else:
-                    self._handle_ctl(xml, data)
-            elif xml.get("type") == "result":
-                if self.type == self.BOT:
-                    self._handle_result(xml, data)
-                else:
-                    self._handle_result(xml, data)
-            elif xml.get("type") == "set":
-                if self.type == self.BOT:
-                    self._handle_result(xml, data)
-                else:
-                    self._handle_result(xml, data)
+            handler = self._IQ_HANDLERS.get(child)
+            if handler:
+                handler(self, xml)
+            elif child == "query" and self.type != self.BOT:
+                self._handle_ctl(xml)
+            elif child == "query" or xml.get("type") in _RESULT_TYPES:
+                self._handle_result(xml)
+
+    # iq handlers by stripped child tag
+    _IQ_HANDLERS: dict[str, Callable[["XMPPAsyncClient", ET.Element], None]] = {
+        "bind": _handle_bind,
+        "session": _handle_session,
+        "ping": _handle_ping,
+    }
@@ -117,6 +117,12 @@ def test_bot_db():
         "xmpp_connection"
     ]  # Test that xmpp was set True for bot
 
+    db.bots_set_xmpp({"did_123": False, "did_missing": True})
+    assert (
+        db.bot_get("did_123")["xmpp_connection"] == False
+    )  # Test that xmpp was set False for bot
+    assert db.bot_get("did_missing") == None  # Test that no bot was added
+
     db.bot_remove("did_123")
     assert db.bot_get("did_123") == None  # Test that bot is no longer in db
 
@@ -138,5 +144,11 @@ def test_client_db():
         len(db.get_disconnected_xmpp_clients()) > 0
     )  # Test len of connected xmpp clients is 1
 
+    db.clients_set_xmpp({"resource_123": True, "resource_missing": False})
+    assert db.client_get("resource_123")[
+        "xmpp_connection"
+    ]  # Test that xmpp was set True for client
+    assert db.client_get("resource_missing") == None  # Test that no client was added
+
     db.client_remove("resource_123")
     assert db.client_get("resource_123") == None
@@ -1,6 +1,7 @@
 import asyncio
 from unittest import mock
 
+import pytest
 from testfixtures import LogCapture
 
 import bumper
@@ -31,7 +32,7 @@ async def test_xmpp_server():
 
         assert len(xmpp_server.clients) == 1  # Client count increased
         assert (
-            xmpp_server.clients[0].address[1]
+            next(iter(xmpp_server.clients.values())).address[1]
             == writer.transport.get_extra_info("sockname")[1]
         )
 
@@ -52,6 +53,37 @@ async def test_xmpp_server():
     xmpp_server.disconnect()
 
 
+def test_xmpp_server_uvloop():
+    uvloop = pytest.importorskip("uvloop")
+
+    async def handshake():
+        xmpp_server = XMPPServer("127.0.0.1", 5224)
+        await xmpp_server.start_async_server()
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", 5224)
+
+        writer.write(
+            b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
+        )  # Start stream
+        await writer.drain()
+
+        # Server opens stream and tells client available features
+        response = await asyncio.wait_for(reader.read(1024), 1)
+        assert response.startswith(b"<stream:stream ")
+        assert b"<stream:features>" in response
+
+        writer.close()  # Close connection
+        await writer.wait_closed()
+
+        xmpp_server.disconnect()
+
+    loop = uvloop.new_event_loop()
+    try:
+        loop.run_until_complete(handshake())
+    finally:
+        loop.close()
+
+
 async def test_client_connect_no_starttls():
     test_transport = mock.Mock()
     test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
@@ -59,23 +91,19 @@ async def test_client_connect_no_starttls():
     xmppclient = XMPPAsyncClient(test_transport)
     xmppclient.state = xmppclient.CONNECT  # Set client state to CONNECT
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+    mock_send_many = xmppclient.send_many = mock.Mock()
 
     # Send connect stream from "client"
     test_data = b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client available features
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client available features
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>',
+    ]
 
     # Reset mock calls
     mock_send.reset_mock()
@@ -91,6 +119,27 @@ async def test_client_connect_no_starttls():
     assert xmppclient.state == xmppclient.INIT  # Client moved to INIT state
 
 
+async def test_client_connect_xml_declaration():
+    test_transport = mock.Mock()
+    test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
+    test_transport.write = mock.Mock(return_value=return_send_data)
+    xmppclient = XMPPAsyncClient(test_transport)
+    xmppclient.state = xmppclient.CONNECT  # Set client state to CONNECT
+    mock_send_many = xmppclient.send_many = mock.Mock()
+
+    with LogCapture("xmppserver") as l:
+        # XML declaration and stream are received separately
+        xmppclient.parse_data(b"<?xml version='1.0'?>")
+        xmppclient.parse_data(
+            b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
+        )
+
+        assert not [r for r in l.records if r.levelname == "ERROR"]
+
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+
+
 async def test_client_end_stream():
     test_transport = mock.Mock()
     test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
@@ -130,28 +179,25 @@ async def test_client_connect_starttls_called():
     xmppclient = XMPPAsyncClient(test_transport)
     xmppclient.state = xmppclient.CONNECT  # Set client state to CONNECT
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+    mock_send_many = xmppclient.send_many = mock.Mock()
 
     # Send connect stream from "client"
     test_data = b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client available features
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client available features
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>',
+    ]
 
     # Reset mock calls
     mock_send.reset_mock()
+    mock_send_many.reset_mock()
 
-    mock_tls = xmppclient._handle_starttls = mock.Mock()
+    mock_tls = xmppclient._handle_starttls = mock.AsyncMock()
 
     # Send start tls from "client"
     test_data = b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
@@ -166,18 +212,13 @@ async def test_client_connect_starttls_called():
     test_data = b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client available features (without STARTTLS)
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client available features (without STARTTLS)
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>',
+    ]
     # Reset mock calls
     mock_send.reset_mock()
 
@@ -203,23 +244,19 @@ async def test_client_init():
     xmppclient.bumper_jid = "fuid_tmpuser@ecouser.net/IOSF53D07BA"
     xmppclient.type = xmppclient.CONTROLLER
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+    mock_send_many = xmppclient.send_many = mock.Mock()
 
     # Send connect stream from "client"
     test_data = b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0' to='ecouser.net'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client binds
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client binds
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>',
+    ]
 
     # Reset mock calls
     mock_send.reset_mock()
@@ -230,9 +267,10 @@ async def test_client_init():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" id="5E9872D5-547E-49AF-AE51-9EFAA282F952"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>fuid_tmpuser@ecouser.net/IOSF53D07BA</jid></bind></iq>'
+        == b'<iq type="result" id="5E9872D5-547E-49AF-AE51-9EFAA282F952"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>fuid_tmpuser@ecouser.net/IOSF53D07BA</jid></bind></iq>'
     )  # client successfully binded
     assert xmppclient.state == xmppclient.BIND  # client moved to BIND state
+    assert xmppclient in bumper.xmppserver.XMPPServer.clients_by_uid["fuid_tmpuser"]
 
     # Reset mock calls
     mock_send.reset_mock()
@@ -244,7 +282,7 @@ async def test_client_init():
     assert xmppclient.state == xmppclient.READY  # client moved to READY state
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" id="FA1041E7-AA27-43DD-BAA3-64DE2DE56AA3" />'
+        == b'<iq type="result" id="FA1041E7-AA27-43DD-BAA3-64DE2DE56AA3" />'
     )  # client ready
 
     # Reset mock calls
@@ -256,7 +294,7 @@ async def test_client_init():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<presence to="fuid_tmpuser@ecouser.net/IOSF53D07BA"> dummy </presence>'
+        == b'<presence to="fuid_tmpuser@ecouser.net/IOSF53D07BA"> dummy </presence>'
     )  # client presence - dummy response
 
 
@@ -267,23 +305,19 @@ async def test_bot_connect():
     xmppclient = XMPPAsyncClient(test_transport)
     xmppclient.state = xmppclient.CONNECT  # Set client state to CONNECT
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+    mock_send_many = xmppclient.send_many = mock.Mock()
 
     # Send connect stream from "bot"
     test_data = b"<stream:stream xmlns:stream='http://etherx.jabber.org/streams' xmlns='jabber:client' to='159.ecorobot.net' version='1.0'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client available features
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client available features
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"><required/></starttls><mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl"><mechanism>PLAIN</mechanism></mechanisms></stream:features>',
+    ]
 
     # Reset mock calls
     mock_send.reset_mock()
@@ -310,23 +344,19 @@ async def test_bot_init():
     xmppclient.devclass = "159"
     xmppclient.type = xmppclient.BOT
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+    mock_send_many = xmppclient.send_many = mock.Mock()
 
     # Send connect stream from "bot"
     test_data = b"<stream:stream xmlns:stream='http://etherx.jabber.org/streams' xmlns='jabber:client' to='159.ecorobot.net' version='1.0'>"
     xmppclient.parse_data(test_data)
 
-    # Expect 2 calls to send
-    assert mock_send.call_count == 2
-    # Server opens stream
-    assert (
-        mock_send.mock_calls[0][1][0]
-        == '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">'
-    )
-    # Server tells client binds
-    assert (
-        mock_send.mock_calls[1][1][0]
-        == '<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>'
-    )
+    # Expect 1 write
+    assert mock_send_many.call_count == 1
+    # Server opens stream and tells client binds
+    assert mock_send_many.mock_calls[0][1][0] == [
+        b'<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client" version="1.0" id="1" from="ecouser.net">',
+        b'<stream:features><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/><session xmlns="urn:ietf:params:xml:ns:xmpp-session"/></stream:features>',
+    ]
 
     # Reset mock calls
     mock_send.reset_mock()
@@ -337,7 +367,7 @@ async def test_bot_init():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" id="2521"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>E0000000000000001234@159.ecorobot.net/atom</jid></bind></iq>'
+        == b'<iq type="result" id="2521"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>E0000000000000001234@159.ecorobot.net/atom</jid></bind></iq>'
     )  # Bot successfully binded
     assert xmppclient.state == xmppclient.BIND  # Bot moved to BIND state
 
@@ -350,7 +380,7 @@ async def test_bot_init():
 
     assert xmppclient.state == xmppclient.READY  # Bot moved to READY state
     assert (
-        mock_send.mock_calls[0][1][0] == '<iq type="result" id="2522" />'
+        mock_send.mock_calls[0][1][0] == b'<iq type="result" id="2522" />'
     )  # Bot ready
 
     # Reset mock calls
@@ -362,7 +392,7 @@ async def test_bot_init():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<presence to="E0000000000000001234@159.ecorobot.net/atom"> dummy </presence>'
+        == b'<presence to="E0000000000000001234@159.ecorobot.net/atom"> dummy </presence>'
     )  # bot presence - dummy response
 
 
@@ -382,8 +412,31 @@ async def test_ping_server():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" id="2542" from="159.ecorobot.net" />'
+        == b'<iq type="result" id="2542" from="159.ecorobot.net" />'
+    )  # ping response
+
+
+async def test_ping_server_split_packets():
+    test_transport = mock.Mock()
+    test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
+    test_transport.write = mock.Mock(return_value=return_send_data)
+    xmppclient = XMPPAsyncClient(test_transport)
+    xmppclient.state = xmppclient.READY  # Set client state to READY
+    xmppclient.uid = "E0000000000000001234"
+    xmppclient.devclass = "159"
+    mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
+
+    # Ping from bot, split over two reads
+    xmppclient.parse_data(b'<iq from="E000BVTNX18700260382@159.ecorobot.net/atom" id=')
+    assert mock_send.call_count == 0  # stanza not complete yet
+
+    xmppclient.parse_data(b'"2543" to="159.ecorobot.net" type="get"><ping /></iq>')
+
+    assert (
+        mock_send.mock_calls[0][1][0]
+        == b'<iq type="result" id="2543" from="159.ecorobot.net" />'
     )  # ping response
+    assert len(xmppclient._root) == 0  # handled stanza released
 
 
 async def test_ping_client_to_client():
@@ -404,8 +457,10 @@ async def test_ping_client_to_client():
     xmppclient2.bumper_jid = "fuid_tmpuser@ecouser.net/IOSF53D07BA"
     mock_send2 = xmppclient2.send = mock.Mock(side_effect=return_send_data)
 
-    bumper.xmppserver.XMPPServer.clients.append(xmppclient)
-    bumper.xmppserver.XMPPServer.clients.append(xmppclient2)
+    bumper.xmppserver.XMPPServer.clients[id(xmppclient)] = xmppclient
+    bumper.xmppserver.XMPPServer.clients[id(xmppclient2)] = xmppclient2
+    bumper.xmppserver.XMPPServer.clients_by_uid["e0000000000000001234"] = [xmppclient]
+    bumper.xmppserver.XMPPServer.clients_by_uid["fuid_tmpuser"] = [xmppclient2]
 
     # Ping from user to bot
     test_data = b'<iq id="104934615" to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="get"><ping xmlns="urn:xmpp:ping" /></iq>'
@@ -413,7 +468,7 @@ async def test_ping_client_to_client():
 
     assert (
         mock_send2.mock_calls[0][1][0]
-        == '<iq id="104934615" to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="get" from="E0000000000000001234@159.ecorobot.net/atom"><ping xmlns="urn:xmpp:ping" /></iq>'
+        == b'<iq id="104934615" to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="get" from="E0000000000000001234@159.ecorobot.net/atom"><ping xmlns="urn:xmpp:ping" /></iq>'
     )  # ping response
 
     # Ping response from bot to user
@@ -422,7 +477,7 @@ async def test_ping_client_to_client():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" to="E0000000000000001234@159.ecorobot.net/atom" id="104934615" from="fuid_tmpuser@ecouser.net/IOSF53D07BA" />'
+        == b'<iq type="result" to="E0000000000000001234@159.ecorobot.net/atom" id="104934615" from="fuid_tmpuser@ecouser.net/IOSF53D07BA" />'
     )  # ping response
 
 
@@ -437,7 +492,7 @@ async def test_client_send_iq():
     xmppclient.bumper_jid = "fuid_tmpuser@ecouser.net/IOSF53D07BA"
     xmppclient.type - xmppclient.CONTROLLER
     mock_send = xmppclient.send = mock.Mock(side_effect=return_send_data)
-    bumper.xmppserver.XMPPServer.clients.append(xmppclient)
+    bumper.xmppserver.XMPPServer.clients[id(xmppclient)] = xmppclient
 
     xmppclient2 = XMPPAsyncClient(test_transport)
     xmppclient2.state = xmppclient.READY  # Set client state to READY
@@ -447,7 +502,9 @@ async def test_client_send_iq():
     xmppclient2.type = xmppclient2.BOT
     mock_send2 = xmppclient2.send = mock.Mock(side_effect=return_send_data)
 
-    bumper.xmppserver.XMPPServer.clients.append(xmppclient2)
+    bumper.xmppserver.XMPPServer.clients[id(xmppclient2)] = xmppclient2
+    bumper.xmppserver.XMPPServer.clients_by_uid["fuid_tmpuser"] = [xmppclient]
+    bumper.xmppserver.XMPPServer.clients_by_uid["e0000000000000001234"] = [xmppclient2]
 
     # Roster IQ - Only seen from Android app so far
     test_data = (
@@ -457,7 +514,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="error" id="EE0XQ-2"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'
+        == b'<iq type="error" id="EE0XQ-2"><error type="cancel" code="501"><feature-not-implemented xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'
     )  # feature not implemented response
 
     # Reset mock calls
@@ -469,7 +526,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send2.mock_calls[0][1][0]
-        == '<iq id="7" to="E0000000000000001234@159.ecorobot.net/atom" type="set" from="fuid_tmpuser@ecouser.net/IOSF53D07BA"><query xmlns="com:ctl"><ctl id="72107787" td="GetCleanState" /></query></iq>'
+        == b'<iq id="7" to="E0000000000000001234@159.ecorobot.net/atom" type="set" from="fuid_tmpuser@ecouser.net/IOSF53D07BA"><query xmlns="com:ctl"><ctl id="72107787" td="GetCleanState" /></query></iq>'
     )  # command was sent to bot
 
     # Reset mock calls
@@ -481,7 +538,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq id="2679" to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="ChargeState"><charge h="0" r="a" type="Going" /></ctl></query></iq>'
+        == b'<iq id="2679" to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="ChargeState"><charge h="0" r="a" type="Going" /></ctl></query></iq>'
     )  # result sent to client
 
     # Reset mock calls
@@ -493,7 +550,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq type="result" from="E0000000000000001234@159.ecorobot.net/atom" to="ecouser.net" id="s2c1" />'
+        == b'<iq type="result" from="E0000000000000001234@159.ecorobot.net/atom" to="ecouser.net" id="s2c1" />'
     )  # result sent to ecouser.net
 
     # Reset mock calls
@@ -505,7 +562,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" id="2700" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="BatteryInfo"><battery power="100" /></ctl></query></iq>'
+        == b'<iq to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" id="2700" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="BatteryInfo"><battery power="100" /></ctl></query></iq>'
     )  # result sent to ecouser.net
 
     # Reset mock calls
@@ -517,7 +574,7 @@ async def test_client_send_iq():
 
     assert (
         mock_send.mock_calls[0][1][0]
-        == '<iq to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" id="631" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="error" errs="102" /></query></iq>'
+        == b'<iq to="fuid_tmpuser@ecouser.net/IOSF53D07BA" type="set" id="631" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><ctl td="error" errs="102" /></query></iq>'
     )  # result sent to ecouser.net
 
     # Reset mock calls
@@ -527,8 +584,81 @@ async def test_client_send_iq():
     test_data = b"<iq to='rl.ecorobot.net' type='set' id='1234'><query xmlns='com:sf'><sf td='pub' t='log' ts='1559893796000' tp='p' k='DeviceAlert' v='DorpError' f='E0000000000000001234@159.ecorobot.net' g='fuid_tmpuser@ecouser.net'/></query></iq>"
     xmppclient2.parse_data(test_data)
     assert mock_send.mock_calls[0][1][0] == (
-        '<iq xmlns="com:sf" to="rl.ecorobot.net" type="set" id="1234" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><sf td="pub" t="log" ts="1559893796000" tp="p" k="DeviceAlert" v="DorpError" f="E0000000000000001234@159.ecorobot.net" g="fuid_tmpuser@ecouser.net" /></query></iq>'
+        b'<iq xmlns="com:sf" to="rl.ecorobot.net" type="set" id="1234" from="E0000000000000001234@159.ecorobot.net/atom"><query xmlns="com:ctl"><sf td="pub" t="log" ts="1559893796000" tp="p" k="DeviceAlert" v="DorpError" f="E0000000000000001234@159.ecorobot.net" g="fuid_tmpuser@ecouser.net" /></query></iq>'
     )  # result sent to ecouser.net
 
     # Reset mock calls
     mock_send.reset_mock()
+
+
+async def test_bot_no_permission():
+    test_transport = mock.Mock()
+    test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
+    test_transport.write = mock.Mock(return_value=return_send_data)
+    xmppclient = XMPPAsyncClient(test_transport)
+    xmppclient.state = xmppclient.READY  # Set client state to READY
+    xmppclient.uid = "E0000000000000001234"
+    xmppclient.devclass = "159"
+    xmppclient.bumper_jid = "E0000000000000001234@159.ecorobot.net/atom"
+    xmppclient.type = xmppclient.BOT
+    mock_send_many = xmppclient.send_many = mock.Mock()
+
+    # Bot reports the user has no permissions
+    test_data = b"<iq type='set' to='fuid_tmpuser@ecouser.net/IOSF53D07BA' id='5'><query xmlns='com:ctl'><ctl td='error' errno='103' error='permission denied, please contact E0000000000000001234@ecouser.net'/></query></iq>"
+    xmppclient.parse_data(test_data)
+
+    # AddUser, SetAC and GetUserInfo are sent to the bot in one write
+    assert mock_send_many.call_count == 1
+    adduser, adduseracs, getuserinfo = mock_send_many.mock_calls[0][1][0]
+    assert b'td="AddUser" id="0000" jid="fuid_tmpuser@ecouser.net"' in adduser
+    assert b'td="SetAC" id="1111" jid="fuid_tmpuser@ecouser.net"' in adduseracs
+    assert b'td="GetUserInfo"' in getuserinfo
+
+
+async def test_xmpp_status_batched():
+    bumper.db.bot_add(
+        "E0000000000000001234", "E0000000000000001234", "159", "atom", "eco-legacy"
+    )
+
+    with mock.patch(
+        "bumper.xmppserver.bots_set_xmpp", wraps=bumper.db.bots_set_xmpp
+    ) as mock_write:
+        # Reconnecting bot, only the latest state is written
+        bumper.xmppserver._xmpp_status.add("E0000000000000001234", "", True)
+        bumper.xmppserver._xmpp_status.add("E0000000000000001234", "", False)
+        bumper.xmppserver._xmpp_status.add("E0000000000000001234", "", True)
+
+        await asyncio.sleep(0.2)
+
+    assert mock_write.call_count == 1
+    assert mock_write.mock_calls[0][1][0]["E0000000000000001234"]
+    assert bumper.db.bot_get("E0000000000000001234")["xmpp_connection"]
+
+
+async def test_failed_stanza_removed_from_root():
+    test_transport = mock.Mock()
+    test_transport.get_extra_info = mock.Mock(return_value=mock_transport_extra_info())
+    xmppclient = XMPPAsyncClient(test_transport)
+    xmppclient.state = xmppclient.READY  # Set client state to READY
+    xmppclient._handle_presence = mock.Mock(side_effect=Exception("bad presence"))
+
+    # Handler raises, the stanza is still dropped from the parser root
+    test_data = b'<presence type="available"/>'
+    xmppclient.parse_data(test_data)
+
+    assert xmppclient._handle_presence.called
+    assert len(xmppclient._root) == 0
+
+
+async def test_xmpp_status_flushed_on_request():
+    xmpp_server = XMPPServer("127.0.0.1", 5223)
+    bumper.db.bot_add(
+        "E0000000000000001234", "E0000000000000001234", "159", "atom", "eco-legacy"
+    )
+    bumper.db.bot_set_xmpp("E0000000000000001234", True)
+
+    # Pending change is written without waiting for the batch delay
+    bumper.xmppserver._xmpp_status.add("E0000000000000001234", "", False)
+    xmpp_server.flush_xmpp_status()
+
+    assert not bumper.db.bot_get("E0000000000000001234")["xmpp_connection"]
@@ -8,6 +8,7 @@ import pytest
 import bumper
 from bumper import HelperBot, WebServer, WebserverBinding, XMPPServer, db
 from bumper.models import ERR_TOKEN_INVALID, RETURN_API_SUCCESS
+from bumper.xmppserver import XMPPAsyncClient
 from tests import HOST, MQTT_PORT, WEBSERVER_PORT
 
 
@@ -51,6 +52,37 @@ async def test_base(webserver_client):
     bumper.xmpp_server.disconnect()
 
 
+@pytest.mark.usefixtures("helper_bot")
+async def test_base_xmpp_clients(webserver_client):
+    remove_existing_db()
+
+    # Start XMPP
+    xmpp_server = XMPPServer(HOST, 5223)
+    bumper.xmpp_server = xmpp_server
+    await xmpp_server.start_async_server()
+
+    # Connected bot
+    test_transport = mock.Mock()
+    test_transport.get_extra_info = mock.Mock(return_value=(HOST, 5223))
+    xmppclient = XMPPAsyncClient(test_transport)
+    xmppclient.uid = "E0000000000000001234"
+    xmppclient.bumper_jid = "E0000000000000001234@159.ecorobot.net/atom"
+    xmppclient.state = xmppclient.READY
+    xmpp_server.clients[id(xmppclient)] = xmppclient
+
+    try:
+        resp = await webserver_client.get("/")
+        assert resp.status == 200
+        text = await resp.text()
+        assert "<td>E0000000000000001234</td>" in text
+        assert "<td>E0000000000000001234@159.ecorobot.net/atom</td>" in text
+        assert " connected " in text and "not connected" not in text
+    finally:
+        xmpp_server.clients.pop(id(xmppclient), None)
+
+    bumper.xmpp_server.disconnect()
+
+
 @pytest.mark.usefixtures("helper_bot")
 async def test_restartService(webserver_client):
     remove_existing_db()